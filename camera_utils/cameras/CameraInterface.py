@@ -21,8 +21,41 @@
 # You should have received a copy of the GNU General Public License. If not, see http://www.gnu.org/licenses/
 ---------------------------------------------------------------------------------------------------------------------------------'''
 from enum import Enum
+import numpy as np
 import open3d as o3d
 
+
+class _BufferPool:
+    '''
+    Rotating set of preallocated images used by the camera getters to avoid allocating a new array at every frame.
+    The image returned by next() is writable until it is handed to the caller through publish(), then it is
+    read-only and stays valid until the pool wraps around (i.e., for the following size-1 calls).
+    '''
+
+    def __init__(self, shape, dtype, size=2):
+        self._buffers = [np.empty(shape, dtype=dtype) for _ in range(size)]
+        for buffer in self._buffers:
+            buffer.setflags(write=False)
+        self._idx = 0
+
+    def next(self):
+        '''
+        :return: the next writable image of the pool
+        '''
+        buffer = self._buffers[self._idx]
+        self._idx = (self._idx + 1) % len(self._buffers)
+        buffer.setflags(write=True)
+        return buffer
+
+    @staticmethod
+    def publish(buffer):
+        '''
+        :return: the read-only image to be returned to the caller
+        '''
+        buffer.setflags(write=False)
+        return buffer
+
+
 class Camera:
 
     class Resolution(Enum):
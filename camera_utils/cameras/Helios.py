@@ -21,17 +21,94 @@
 # You should have received a copy of the GNU General Public License. If not, see http://www.gnu.org/licenses/
 ---------------------------------------------------------------------------------------------------------------------------------'''
 import numpy as np
-from camera_utils.cameras.CameraInterface import Camera
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from camera_utils.cameras.CameraInterface import Camera, _BufferPool
 from arena_api.system import system
-from arena_api.buffer import BufferFactory
 import cv2
+import numba
 import open3d as o3d
 
+# Coord3D_ABCY16 pixel: A, B, C coordinates and Y intensity interleaved as little endian uint16
+HELIOS_DTYPE = np.dtype([('A', '<u2'), ('B', '<u2'), ('C', '<u2'), ('Y', '<u2')])
+
+
+@numba.njit(parallel=True, cache=True, fastmath=True, nogil=True)
+def _abc_to_xyz(src_A, src_B, src_C, sA, oA, sB, oB, sC, oC, out_xyz):
+    '''
+    Convert the A, B, C planes of an ABCY16 image in a XYZ float32 point cloud in a single pass.
+    '''
+    H, W = src_A.shape[0], src_A.shape[1]
+    for y in numba.prange(H):
+        for x in range(W):
+            out_xyz[y, x, 0] = src_A[y, x] * sA + oA
+            out_xyz[y, x, 1] = src_B[y, x] * sB + oB
+            out_xyz[y, x, 2] = src_C[y, x] * sC + oC
+
+
+@numba.njit(parallel=True, cache=True, nogil=True)
+def _apply_lut_u16(src, lut, out):
+    '''
+    Map each uint16 pixel of src through lut writing the result in out.
+    '''
+    H, W = src.shape[0], src.shape[1]
+    for y in numba.prange(H):
+        for x in range(W):
+            out[y, x] = lut[src[y, x]]
+
+
+@numba.njit(parallel=True, fastmath=True, nogil=True, cache=True)
+def _process_frame_ABCY16(src_C, src_Y, depth_lut, intensity_u8, depth_u16, intensity_range, range_weight):
+    '''
+    Compute depth (through depth_lut) and min-max normalized intensity reading the C and Y planes once.
+    The intensity range [min, max] is kept in intensity_range and updated with weight range_weight
+    (1: range of the current frame, 0: keep the previous range and skip its computation).
+    '''
+    H, W = src_C.shape[0], src_C.shape[1]
+    if range_weight > 0:
+        row_mn = np.empty(H, dtype=np.uint16)
+        row_mx = np.empty(H, dtype=np.uint16)
+        for y in numba.prange(H):
+            mn = src_Y[y, 0]
+            mx = src_Y[y, 0]
+            for x in range(W):
+                depth_u16[y, x] = depth_lut[src_C[y, x]]
+                v = src_Y[y, x]
+                mn = min(mn, v)
+                mx = max(mx, v)
+            row_mn[y] = mn
+            row_mx[y] = mx
+        intensity_range[0] = (1.0 - range_weight) * intensity_range[0] + range_weight * row_mn.min()
+        intensity_range[1] = (1.0 - range_weight) * intensity_range[1] + range_weight * row_mx.max()
+    else:
+        for y in numba.prange(H):
+            for x in range(W):
+                depth_u16[y, x] = depth_lut[src_C[y, x]]
+    mn = intensity_range[0]
+    mx = intensity_range[1]
+    alpha = 255.0 / (mx - mn) if mx > mn else 0.0
+    for y in numba.prange(H):
+        for x in range(W):
+            v = (src_Y[y, x] - mn) * alpha + 0.5
+            intensity_u8[y, x] = np.uint8(min(max(v, 0.0), 255.0))
+
+
 class Helios(Camera):
 
     def __init__(self, camera_resolution=Camera.Resolution.HD, fps=30,
-                 serial_number="", depth_in_meters=False):
-
+                 serial_number="", depth_in_meters=False, copy_buffer=False, threaded_capture=False,
+                 intensity_range_period=1):
+        '''
+        :param copy_buffer: if True each camera buffer is copied in a persistent scratch image and requeued
+                            immediately, otherwise frames are processed in place and requeued afterwards
+        :param threaded_capture: if True rgb and depth frames are grabbed and processed by a background thread,
+                                 so that the next frame is ready while the caller works on the previous one
+        :param intensity_range_period: the intensity min/max used for the normalization are computed every
+                                       intensity_range_period frames and smoothed over time. With 1 (default)
+                                       each frame is normalized with its own min/max
+        '''
         import time
 
         self.camera_brand = "LucidVision Helios"
@@ -104,11 +181,66 @@ class Helios(Camera):
         self.scale_C = nodemap["Scan3dCoordinateScale"].value
         self.offset_C = nodemap["Scan3dCoordinateOffset"].value
 
+        # scale and offset are fixed after configuration, so the depth conversion is a static uint16 -> uint16 table
+        self._depth_lut = np.clip(np.arange(65536) * self.scale_C + self.offset_C, 0, 65535).astype(np.uint16)
+        self._copy_buffer = copy_buffer
+        self._scratch = np.empty((self.intr["height"], self.intr["width"]), dtype=HELIOS_DTYPE) if copy_buffer else None
+
+        # output images are written in these rotating buffers at each frame instead of allocating new ones
+        # (one pool per getter, so that a getter never overwrites the images returned by another one)
+        self._rgb_pool = _BufferPool((self.intr["height"], self.intr["width"]), np.uint8)
+        self._depth_pool = _BufferPool((self.intr["height"], self.intr["width"]), np.uint16)
+        self._frames_rgb_pool = _BufferPool((self.intr["height"], self.intr["width"]), np.uint8)
+        self._frames_depth_pool = _BufferPool((self.intr["height"], self.intr["width"]), np.uint16)
+        self._xyz_pool = _BufferPool((self.intr["height"], self.intr["width"], 3), np.float32)
+        self._intensity_u16 = np.empty((self.intr["height"], self.intr["width"]), dtype=np.uint16) # deinterleaved intensity scratch
+
+        # intensity normalization range [min, max], recomputed every intensity_range_period frames
+        self._intensity_range = np.array([0.0, 65535.0])
+        self._intensity_range_period = max(1, int(intensity_range_period))
+        self._intensity_frame_ctr = 0
+
+        # the camera buffer can be accessed by the capture thread and by the caller (e.g., get_xyz)
+        self._pipeline_lock = threading.Lock()
+        self._capture_thread = None
+        if threaded_capture:
+            # ring of (intensity, depth) frames: the latest frame and the last two returned ones are never overwritten
+            self._ring = [(np.empty((self.intr["height"], self.intr["width"]), dtype=np.uint8),
+                           np.empty((self.intr["height"], self.intr["width"]), dtype=np.uint16)) for _ in range(4)]
+            self._ring_latest = None
+            self._ring_returned = deque(maxlen=2)
+            self._frame_count = 0
+            self._frame_read = 0
+            self._capture_error = None
+            self._capturing = True
+            self._frame_cond = threading.Condition()
+            self._capture_thread = threading.Thread(target=Helios._capture_loop, args=(weakref.ref(self),), daemon=True)
+
+        self._warmup_kernels()
+
         self.pipeline.start_stream()
+        if self._capture_thread is not None:
+            self._capture_thread.start()
 
         print("%s %s camera configured.\n" % (self.camera_name, self.serial_number))
 
+    def _warmup_kernels(self):
+        '''
+        Compile the Numba kernels on dummy frames, so that the first real frame does not pay the JIT cost.
+        Kernels are cached on disk (see NUMBA_CACHE_DIR), so from the second run on they are only loaded.
+        '''
+        dummy = np.zeros((16, 16), dtype=HELIOS_DTYPE)
+        _abc_to_xyz(dummy['A'], dummy['B'], dummy['C'], self.scale_A, self.offset_A, self.scale_B, self.offset_B,
+                    self.scale_C, self.offset_C, np.empty((16, 16, 3), dtype=np.float32))
+        _apply_lut_u16(dummy['C'], self._depth_lut, np.empty((16, 16), dtype=np.uint16))
+        _process_frame_ABCY16(dummy['C'], dummy['Y'], self._depth_lut, np.empty((16, 16), dtype=np.uint8),
+                              np.empty((16, 16), dtype=np.uint16), np.array([0.0, 65535.0]), 1.0)
+
     def __del__(self):
+        if getattr(self, '_capture_thread', None) is not None:
+            self._capturing = False
+            if threading.current_thread() is not self._capture_thread:
+                self._capture_thread.join(timeout=1.0)
         try:
             system.destroy_device()
             print("%s %s camera closed" % (self.camera_name, self.serial_number))
@@ -116,54 +248,170 @@ class Helios(Camera):
             print("\033[0;33;40mException (%s): %s\033[0m" % (type(ex).__name__, ex))
         
 
+    @contextmanager
+    def _frame_buffer(self):
+        '''
+        Get a buffer from the camera and yield it as a (height, width) HELIOS_DTYPE view (fields A, B, C, Y).
+        The view points directly to the camera buffer (no copy) which is requeued on exit,
+        hence the data must be consumed inside the with statement.
+        If copy_buffer is set the buffer is copied in a persistent scratch image and requeued before yielding it.
+        '''
+        with self._pipeline_lock:
+            buffer = self.pipeline.get_buffer()
+            try:
+                if (buffer.height, buffer.width) != (self.intr["height"], self.intr["width"]):
+                    raise RuntimeError("%s %s: unexpected buffer size %dx%d" % (self.camera_name, self.serial_number, buffer.width, buffer.height))
+                frame = np.ctypeslib.as_array(buffer.pdata, shape=(buffer.height, buffer.width * HELIOS_DTYPE.itemsize)).view(HELIOS_DTYPE)
+                if self._copy_buffer:
+                    np.copyto(self._scratch, frame)
+                    frame = self._scratch
+                    buffer, copied_buffer = None, buffer
+                    self.pipeline.requeue_buffer(copied_buffer)
+                yield frame
+            finally:
+                if buffer is not None:
+                    self.pipeline.requeue_buffer(buffer)
+
+    @staticmethod
+    def _capture_loop(camera_ref):
+        '''
+        Background capture: process camera frames in a free slot of the ring and publish it as the latest frame.
+        Kernels and OpenCV release the GIL, so the caller can run while the next frame is grabbed and processed.
+        The camera is referenced weakly so that it can still be garbage collected (and closed) by the caller.
+        '''
+        while True:
+            camera = camera_ref()
+            if camera is None or not camera._capturing:
+                return
+            try:
+                camera._capture_frame()
+            except Exception as ex:
+                with camera._frame_cond:
+                    camera._capture_error = ex
+                    camera._frame_cond.notify_all()
+                return
+            del camera
+
+    def _capture_frame(self):
+        with self._frame_cond:
+            idx = next(i for i in range(len(self._ring)) if i != self._ring_latest and i not in self._ring_returned)
+        intensity, depth = self._ring[idx]
+        intensity.setflags(write=True)
+        depth.setflags(write=True)
+        with self._frame_buffer() as frame:
+            _process_frame_ABCY16(frame['C'], frame['Y'], self._depth_lut, intensity, depth,
+                                  self._intensity_range, self._next_range_weight())
+        intensity.setflags(write=False)
+        depth.setflags(write=False)
+        with self._frame_cond:
+            self._ring_latest = idx
+            self._frame_count += 1
+            self._frame_cond.notify_all()
+
+    def _next_captured_frame(self):
+        '''
+        Wait for a frame newer than the one returned by the previous call. Frames processed by the capture
+        thread in between are skipped.
+
+        :return: intensity, depth of the newest frame processed by the capture thread
+        '''
+        with self._frame_cond:
+            self._frame_cond.wait_for(lambda: self._frame_count > self._frame_read or self._capture_error is not None)
+            if self._capture_error is not None:
+                raise RuntimeError("Helios capture thread stopped (%s): %s" % (type(self._capture_error).__name__, self._capture_error))
+            self._frame_read = self._frame_count
+            self._ring_returned.append(self._ring_latest)
+            return self._ring[self._ring_latest]
+
+    def _next_range_weight(self):
+        '''
+        :return: weight of the current frame in the intensity range update (0 if the range is not recomputed)
+        '''
+        frame_ctr = self._intensity_frame_ctr
+        self._intensity_frame_ctr += 1
+        if self._intensity_range_period == 1 or frame_ctr == 0:
+            return 1.0
+        if frame_ctr % self._intensity_range_period == 0:
+            return 0.3 # exponential moving average of the range
+        return 0.0
+
+    def _compute_intensity(self, frame, out):
+        # min-max normalization to [0, 255]: rescale and uint8 cast fused in a single convertScaleAbs pass
+        # the Y plane is deinterleaved by OpenCV looking at the frame as a 4 channels uint16 image
+        intensity = cv2.extractChannel(frame.view(np.uint16).reshape(frame.shape + (4,)), 3, self._intensity_u16)
+        range_weight = self._next_range_weight()
+        if range_weight > 0:
+            mn, mx, _, _ = cv2.minMaxLoc(intensity)
+            self._intensity_range *= 1.0 - range_weight
+            self._intensity_range += range_weight * np.array([mn, mx])
+        mn, mx = self._intensity_range
+        if range_weight < 1.0:
+            # values under a smoothed min would be mirrored by convertScaleAbs
+            cv2.max(intensity, mn, dst=intensity)
+        alpha = 255.0 / (mx - mn) if mx > mn else 1.0
+        cv2.convertScaleAbs(intensity, dst=out, alpha=alpha, beta=-mn * alpha)
+
+    def _compute_depth(self, frame, out):
+        # z * scale + offset as a single look-up pass on the interleaved buffer
+        _apply_lut_u16(frame['C'], self._depth_lut, out)
+
+    # NOTE: the returned images are read-only views of internal buffers which are reused after two calls
+    # of the same getter (of any getter with threaded_capture). Use .copy() if you need to modify them or keep them longer.
+
     def get_rgb(self):
         '''
         :return: An rgb image as numpy array
         '''
-        buffer = self.pipeline.get_buffer()
-        item = BufferFactory.copy(buffer)
-        self.pipeline.requeue_buffer(buffer)
+        if self._capture_thread is not None:
+            return self._next_captured_frame()[0]
 
-        npndarray = np.ctypeslib.as_array(item.pdata, shape=(item.height, item.width, int(item.bits_per_pixel / 8))).view(np.uint16)
-        intensity = np.array(npndarray[:,:,3], dtype=np.uint16)
-        cv2.normalize(intensity, intensity, 0, 255, cv2.NORM_MINMAX)
-        intensity = np.uint8(intensity)
+        intensity = self._rgb_pool.next()
+        with self._frame_buffer() as frame:
+            self._compute_intensity(frame, intensity)
 
-        return intensity
+        return _BufferPool.publish(intensity)
 
 
     def get_depth(self):
         '''
         :return: A depth image (1 channel) as numpy array
         '''
-        buffer = self.pipeline.get_buffer()
-        item = BufferFactory.copy(buffer)
-        self.pipeline.requeue_buffer(buffer)
+        if self._capture_thread is not None:
+            return self._next_captured_frame()[1]
 
-        npndarray = np.ctypeslib.as_array(item.pdata, shape=(item.height, item.width, int(item.bits_per_pixel / 8))).view(np.uint16)
-        npndarray[:,:,2] = npndarray[:,:,2] * self.scale_C + self.offset_C # z * scale + offset
-        depth = np.array(npndarray[:,:,2], dtype=np.uint16)
+        depth = self._depth_pool.next()
+        with self._frame_buffer() as frame:
+            self._compute_depth(frame, depth)
 
-        return depth
+        return _BufferPool.publish(depth)
         
 
     def get_frames(self):
         '''
         :return: rgb, depth images as numpy arrays
         '''
-        buffer = self.pipeline.get_buffer()
-        item = BufferFactory.copy(buffer)
-        self.pipeline.requeue_buffer(buffer)
+        if self._capture_thread is not None:
+            return self._next_captured_frame()
 
-        npndarray = np.ctypeslib.as_array(item.pdata, shape=(item.height, item.width, int(item.bits_per_pixel / 8))).view(np.uint16)
-        npndarray[:,:,2] = npndarray[:,:,2]*self.scale_C + self.offset_C # z * scale + offset
-        
-        depth = np.array(npndarray[:,:,2], dtype=np.uint16)
-        intensity = np.array(npndarray[:,:,3], dtype=np.uint16)
-        cv2.normalize(intensity, intensity, 0, 255, cv2.NORM_MINMAX)
-        intensity = np.uint8(intensity)
+        intensity = self._frames_rgb_pool.next()
+        depth = self._frames_depth_pool.next()
+        with self._frame_buffer() as frame:
+            _process_frame_ABCY16(frame['C'], frame['Y'], self._depth_lut, intensity, depth,
+                                  self._intensity_range, self._next_range_weight())
+
+        return _BufferPool.publish(intensity), _BufferPool.publish(depth)
+
+
+    def get_xyz(self):
+        '''
+        :return: A point cloud (3 channels: x, y, z) as float32 numpy array. Values are in camera units (mm)
+        '''
+        xyz = self._xyz_pool.next()
+        with self._frame_buffer() as frame:
+            _abc_to_xyz(frame['A'], frame['B'], frame['C'], self.scale_A, self.offset_A, self.scale_B, self.offset_B,
+                        self.scale_C, self.offset_C, xyz)
 
-        return intensity, depth
+        return _BufferPool.publish(xyz)
 
 
     def get_aligned_frames(self):
@@ -21,7 +21,7 @@
 # You should have received a copy of the GNU General Public License. If not, see http://www.gnu.org/licenses/
 ---------------------------------------------------------------------------------------------------------------------------------'''
 import numpy as np
-from camera_utils.cameras.CameraInterface import Camera
+from camera_utils.cameras.CameraInterface import Camera, _BufferPool
 import pyrealsense2 as rs
 import open3d as o3d
 
@@ -68,6 +68,12 @@ class IntelRealsense(Camera):
             print("\n\033[1;31;40mError during camera initialization.\nMake sure to have set the right RGB camera resolution. Some cameras doesn't have FullHD resolution (e.g. Intel Realsense D455).\nIf you have connected more cameras make sure to insert the serial numbers to distinguish cameras during initialization.\033[0m\n")
             exit(1)
 
+        # frames are waited once per call, a missing frame after this time is reported as an error
+        self._timeout_ms = 5000
+
+        # align object is created once and reused by get_aligned_frames
+        self._align = rs.align(rs.stream.color)
+
         # setting camera name from camera info
         name_profile = config.resolve(self.pipeline)
         device = name_profile.get_device()
@@ -77,6 +83,7 @@ class IntelRealsense(Camera):
         profile = cfg.get_stream(rs.stream.color)
         intr = profile.as_video_stream_profile().get_intrinsics()
         self.intr = {'fx': intr.fx, 'fy': intr.fy, 'px': intr.ppx, 'py': intr.ppy, 'width': intr.width, 'height': intr.height}
+        self._color_shape = (self.intr['height'], self.intr['width'], 3) # bgr8
         
         self.o3d_intr = o3d.camera.PinholeCameraIntrinsic()
         self.o3d_intr.set_intrinsics(self.intr["width"], self.intr["height"], self.intr['fx'], self.intr['fy'], self.intr['px'], self.intr['py'])
@@ -85,6 +92,8 @@ class IntelRealsense(Camera):
             self.mm2m_conversion = 1000
         else:
             self.mm2m_conversion = 1
+        self._needs_conv = (self.mm2m_conversion != 1)
+        self._depth_pools = {} # converted depth buffers, one pool per (getter, depth shape) (aligned depth has the color shape)
 
         print("%s (S/N: %s) camera configured.\n" % (self.camera_name, self.serial_number))
 
@@ -96,58 +105,72 @@ class IntelRealsense(Camera):
             print("\033[0;33;40mException (%s): %s\033[0m" % (type(ex).__name__, ex))
         
 
+    def _convert_depth(self, depth_frame, getter):
+        '''
+        :param depth_frame: realsense depth frame
+        :param getter: name of the calling getter, each getter has its own buffers
+        :return: depth image as uint16 numpy array, converted in meters if depth_in_meters is set.
+                 The converted image is a read-only internal buffer reused after two calls of the same getter, use .copy() to keep it
+        '''
+        depth = np.frombuffer(depth_frame.get_data(), dtype=np.uint16).reshape(depth_frame.get_height(), depth_frame.get_width())
+        if not self._needs_conv:
+            return depth
+        pool_key = (getter, depth.shape)
+        if pool_key not in self._depth_pools:
+            self._depth_pools[pool_key] = _BufferPool(depth.shape, np.uint16)
+        depth_out = self._depth_pools[pool_key].next()
+        # integer division gives the same truncated result of the float division in a single uint16 pass
+        np.floor_divide(depth, self.mm2m_conversion, out=depth_out)
+        return _BufferPool.publish(depth_out)
+
     def get_rgb(self):
         '''
         :return: An rgb image as numpy array
         '''
-        color_frame = None
-        while not color_frame:
-            frames = self.pipeline.wait_for_frames()
-            color_frame = frames.get_color_frame()
+        frames = self.pipeline.wait_for_frames(self._timeout_ms)
+        color_frame = frames.get_color_frame()
+        if not color_frame:
+            raise RuntimeError("%s (S/N: %s): color frame drop" % (self.camera_name, self.serial_number))
 
-        color_frame = np.asanyarray(color_frame.get_data())
+        color_frame = np.frombuffer(color_frame.get_data(), dtype=np.uint8).reshape(self._color_shape)
         return color_frame
 
     def get_depth(self):
         '''
         :return: A depth image (1 channel) as numpy array
         '''
-        depth_frame = None
-        while not depth_frame:
-            frames = self.pipeline.wait_for_frames()
-            depth_frame = frames.get_depth_frame()
-        depth_frame = np.asanyarray(depth_frame.get_data(), dtype=np.uint16) 
-        return np.asanyarray(depth_frame / self.mm2m_conversion, dtype=np.uint16)
+        frames = self.pipeline.wait_for_frames(self._timeout_ms)
+        depth_frame = frames.get_depth_frame()
+        if not depth_frame:
+            raise RuntimeError("%s (S/N: %s): depth frame drop" % (self.camera_name, self.serial_number))
+        return self._convert_depth(depth_frame, 'get_depth')
 
     def get_frames(self):
         '''
         :return: rgb, depth images as numpy arrays
         '''
-        depth_frame_cam, color_frame_cam = None, None
-        while not color_frame_cam or not depth_frame_cam:
-            frames = self.pipeline.wait_for_frames()
-            depth_frame_cam = frames.get_depth_frame()
-            color_frame_cam = frames.get_color_frame()
-        depth_frame = np.asanyarray(depth_frame_cam.get_data()) / self.mm2m_conversion
-        color_frame = np.asanyarray(color_frame_cam.get_data())
+        frames = self.pipeline.wait_for_frames(self._timeout_ms)
+        depth_frame_cam = frames.get_depth_frame()
+        color_frame_cam = frames.get_color_frame()
+        if not color_frame_cam or not depth_frame_cam:
+            raise RuntimeError("%s (S/N: %s): color or depth frame drop" % (self.camera_name, self.serial_number))
+        color_frame = np.frombuffer(color_frame_cam.get_data(), dtype=np.uint8).reshape(self._color_shape)
 
-        return color_frame, np.asanyarray(depth_frame / self.mm2m_conversion, dtype=np.uint16)
+        return color_frame, self._convert_depth(depth_frame_cam, 'get_frames')
 
     def get_aligned_frames(self):
         '''
         :return: rgb, depth images aligned with post-processing as numpy arrays
         '''
-        depth_frame_cam, color_frame_cam = None, None
-        while not color_frame_cam or not depth_frame_cam:
-            frames = self.pipeline.wait_for_frames()
-            align = rs.align(rs.stream.color)
-            aligned_frames = align.process(frames)
-            color_frame_cam = aligned_frames.first(rs.stream.color)
-            depth_frame_cam = aligned_frames.get_depth_frame()
-        depth_frame = np.asanyarray(depth_frame_cam.get_data()) / self.mm2m_conversion
-        color_frame = np.asanyarray(color_frame_cam.get_data())
-
-        return color_frame, np.asanyarray(depth_frame / self.mm2m_conversion, dtype=np.uint16)
+        frames = self.pipeline.wait_for_frames(self._timeout_ms)
+        aligned_frames = self._align.process(frames)
+        color_frame_cam = aligned_frames.first(rs.stream.color)
+        depth_frame_cam = aligned_frames.get_depth_frame()
+        if not color_frame_cam or not depth_frame_cam:
+            raise RuntimeError("%s (S/N: %s): color or depth frame drop" % (self.camera_name, self.serial_number))
+        color_frame = np.frombuffer(color_frame_cam.get_data(), dtype=np.uint8).reshape(self._color_shape)
+
+        return color_frame, self._convert_depth(depth_frame_cam, 'get_aligned_frames')
 
     def get_pcd(self, depth_truncation=5.0):
         '''
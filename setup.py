@@ -10,7 +10,7 @@ setup(
     version='1.0.0',
     packages=find_packages(),
     data_files=[],
-    install_requires=['setuptools', 'numpy', 'open3d', 'pyrealsense2', 'imutils'],
+    install_requires=['setuptools', 'numpy', 'numba', 'open3d', 'pyrealsense2', 'imutils'],
     zip_safe=True,
     url='https://github.com/IASRobolab/camera_utils',
     maintainer='frollo',